@@ -1,9 +1,12 @@
 # A general-purpose PDF text-layer redaction tool.
 
+import io
+import struct
 import sys
+import xml.etree.ElementTree
 from datetime import datetime
 
-from pdfrw import PdfDict
+from pdfrw import PdfDict, PdfString
 
 class RedactorOptions:
 	"""Redaction and I/O options."""
@@ -51,6 +54,13 @@ class RedactorOptions:
 	#
 	# Each filter is a tuple of a compiled regular expression and a function to generate
 	# replacement text, which is given a re.Match object as its sole argument. It must return a string.
+	# A replacement string may be given instead of a function. As with re.sub, it may contain
+	# backreferences like \1. A string without backslashes is used as is for every match,
+	# which skips calling a function per match; one with backreferences is expanded for each
+	# match, which is slower than a function.
+	#
+	# Patterns compiled with the third-party regex module (which has a faster engine for
+	# patterns with lots of lookarounds) can be used in place of the re module's patterns.
 	#
 	# Since spaces in PDFs are sometimes not encoded as text but instead as positional
 	# offsets (like newlines), the regular expression should treat all spaces as optional.
@@ -70,6 +80,11 @@ class RedactorOptions:
 	# remove the link.
 	link_filters = []
 
+	# Parsed font CMaps are normally kept only while redacting one document. To reuse them
+	# across documents that embed the same CMaps, set this to a dict that is kept between
+	# calls. It is only ever added to, so the caller is responsible for clearing it.
+	cmap_cache = None
+
 
 def redactor(options):
 	# This is the function that performs redaction.
@@ -101,10 +116,11 @@ def redactor(options):
 		text_layer = build_text_layer(document, options)
 
 		# Apply filters to the text stream.
-		update_text_layer(options, *text_layer)
-
-		# Replace page content streams with updated tokens.
-		apply_updated_text(document, *text_layer)
+		if update_text_layer(options, *text_layer):
+			# Replace page content streams with updated tokens, but only if
+			# a filter matched something. Otherwise the original streams can
+			# be written out as they are.
+			apply_updated_text(document, *text_layer)
 
 	# Update annotations.
 	update_annotations(document, options)
@@ -112,7 +128,23 @@ def redactor(options):
 	# Write the PDF back out.
 	writer = PdfWriter()
 	writer.trailer = document
-	writer.write(options.output_stream)
+	if isinstance(options.output_stream, io.RawIOBase):
+		# PdfWriter makes a separate small write for each object and each
+		# cross-reference entry, which would each be a system call on an
+		# unbuffered stream. Buffer them, then detach so the caller's stream
+		# isn't closed when the buffer goes away, even if writing fails.
+		# (PdfReader reads its input in one call, so the input stream doesn't
+		# need this.)
+		output_stream = io.BufferedWriter(options.output_stream, 1 << 20)
+		try:
+			writer.write(output_stream)
+		finally:
+			try:
+				output_stream.flush()
+			finally:
+				output_stream.detach()
+	else:
+		writer.write(options.output_stream)
 
 
 def update_metadata(trailer, options):
@@ -121,6 +153,7 @@ def update_metadata(trailer, options):
 	# (the latter two containing Date values, the rest strings).
 
 	import codecs
+	import itertools
 	from pdfrw.objects import PdfString, PdfName
 
 	# Create the metadata dict if it doesn't exist, since the caller may be adding fields.
@@ -129,8 +162,13 @@ def update_metadata(trailer, options):
 
 	# Get a list of all metadata fields that exist in the PDF plus any fields
 	# that there are metadata filters for (since they may insert field values).
-	keys = set(str(k)[1:] for k in trailer.Info.keys()) \
-		 | set(k for k in options.metadata_filters.keys() if k not in ("DEFAULT", "ALL"))
+	# (PdfNames are strs starting with a slash, so slice it off.)
+	keys = set(k[1:] for k in trailer.Info.keys()) \
+		 | (set(options.metadata_filters) - set(("DEFAULT", "ALL")))
+
+	# The DEFAULT and ALL functions are the same for every field.
+	default_functions = options.metadata_filters.get("DEFAULT", [])
+	all_functions = options.metadata_filters.get("ALL", [])
 
 	# Update each metadata field.
 	for key in keys:
@@ -138,13 +176,14 @@ def update_metadata(trailer, options):
 		functions = options.metadata_filters.get(key)
 		if functions is None:
 			# If nothing is defined for this field, use the DEFAULT functions.
-			functions = options.metadata_filters.get("DEFAULT", [])
+			functions = default_functions
 
-		# Append the ALL functions.
-		functions += options.metadata_filters.get("ALL", [])
+		# Append the ALL functions. (Don't modify the caller's lists.)
+		functions = itertools.chain(functions, all_functions)
 
 		# Run the functions on any existing values.
-		value = trailer.Info[PdfName(key)]
+		name = PdfName(key)
+		value = trailer.Info[name]
 		for f in functions:
 			# Before passing to the function, convert from a PdfString to a Python string.
 			if isinstance(value, PdfString):
@@ -176,7 +215,7 @@ def update_metadata(trailer, options):
 					(repr(value), f.__name__ or "anonymous function"))
 
 			# Replace value.
-			trailer.Info[PdfName(key)] = value
+			trailer.Info[name] = value
 
 
 def update_xmp_metadata(trailer, options):
@@ -199,21 +238,10 @@ def update_xmp_metadata(trailer, options):
 	else:
 		# Serialize the XML and save it into the PDF metadata.
 
-		# Get the serializer.
-		serializer = options.xmp_serializer
-		if serializer is None:
-			# Use a default serializer based on xml.etree.ElementTree.tostring.
-			def serializer(xml_root):
-				import xml.etree.ElementTree
-				if hasattr(xml.etree.ElementTree, 'register_namespace'):
-					# Beginning with Python 3.2 we can define namespace prefixes.
-					xml.etree.ElementTree.register_namespace("xmp", "adobe:ns:meta/")
-					xml.etree.ElementTree.register_namespace("pdf13", "http://ns.adobe.com/pdf/1.3/")
-					xml.etree.ElementTree.register_namespace("xap", "http://ns.adobe.com/xap/1.0/")
-					xml.etree.ElementTree.register_namespace("dc", "http://purl.org/dc/elements/1.1/")
-					xml.etree.ElementTree.register_namespace("rdf", "http://www.w3.org/1999/02/22-rdf-syntax-ns#")
-				return xml.etree.ElementTree.tostring(xml_root, encoding='unicode' if sys.version_info>=(3,0) else None)
-		
+		# Get the serializer, or use a default serializer based on
+		# xml.etree.ElementTree.tostring.
+		serializer = options.xmp_serializer or default_xmp_serializer
+
 		# Create a fresh Metadata dictionary and serialize the XML into it.
 		trailer.Root.Metadata = PdfDict()
 		trailer.Root.Metadata.Type = "Metadata"
@@ -221,6 +249,19 @@ def update_xmp_metadata(trailer, options):
 		trailer.Root.Metadata.stream = serializer(value)
 
 
+if hasattr(xml.etree.ElementTree, 'register_namespace'):
+	# Beginning with Python 3.2 we can define namespace prefixes. The
+	# registry is global, so this only needs to be done once.
+	xml.etree.ElementTree.register_namespace("xmp", "adobe:ns:meta/")
+	xml.etree.ElementTree.register_namespace("pdf13", "http://ns.adobe.com/pdf/1.3/")
+	xml.etree.ElementTree.register_namespace("xap", "http://ns.adobe.com/xap/1.0/")
+	xml.etree.ElementTree.register_namespace("dc", "http://purl.org/dc/elements/1.1/")
+	xml.etree.ElementTree.register_namespace("rdf", "http://www.w3.org/1999/02/22-rdf-syntax-ns#")
+
+def default_xmp_serializer(xml_root):
+	return xml.etree.ElementTree.tostring(xml_root, encoding='unicode' if sys.version_info>=(3,0) else None)
+
+
 class InlineImage(PdfDict):
 	def read_data(self, tokens):
 		# "Unless the image uses ASCIIHexDecode or ASCII85Decode as one
@@ -357,137 +398,176 @@ def build_text_layer(document, options):
 	#
 	# To know the active font, we look for the "<font> <size> Tf" operator.
 
-	from pdfrw import PdfObject, PdfString, PdfArray
-	from pdfrw.uncompress import uncompress as uncompress_streams
-	from pdfrw.objects.pdfname import BasePdfName
-
 	text_tokens = []
 	fontcache = { }
 
-	class TextToken:
-		value = None
-		font = None
-		def __init__(self, value, font):
-			self.font = font
-			self.raw_original_value = value
-			self.original_value = toUnicode(value, font, fontcache)
-			self.value = self.original_value
-		def __str__(self):
-			# __str__ is used for serialization
-			if self.value == self.original_value:
-				# If unchanged, return the raw original value without decoding/encoding.
-				return PdfString.from_bytes(self.raw_original_value)
-			else:
-				# If the value changed, encode it from Unicode according to the encoding
-				# of the font that is active at the location of this token.
-				return PdfString.from_bytes(fromUnicode(self.value, self.font, fontcache, options))
-		def __repr__(self):
-			# __repr__ is used for debugging
-			return "Token<%s>" % repr(self.value)
-
-	def process_text(token):
-		if token.value == "": return
-		text_tokens.append(token)
-
 	# For each page...
 	page_tokens = []
 	for page in document.pages:
-		# For each token in the content stream...
-
 		# Remember this page's revised token list.
-		token_list = []
-		page_tokens.append(token_list)
+		page_tokens.append(build_page_text_layer(page, text_tokens, fontcache, options))
 
-		if page.Contents is None:
-			continue
+	return (text_tokens, page_tokens)
 
-		prev_token = None
-		prev_prev_token = None
-		current_font = None
 
-		# The page may have one content stream or an array of content streams.
-		# If an array, they are treated as if they are concatenated into a single
-		# stream (per the spec).
-		if isinstance(page.Contents, PdfArray):
-			contents = list(page.Contents)
-		else:
-			contents = [page.Contents]
-
-		# If a compression Filter is applied, attempt to un-apply it. If an unrecognized
-		# filter is present, an error is raised. uncompress_streams expects an array of
-		# streams.
-		uncompress_streams(contents)
-
-		def make_mutable_string_token(token):
-			if isinstance(token, PdfString):
-				token = TextToken(token.to_bytes(), current_font)
-
-				# Remember all unicode characters seen in this font so we can
-				# avoid inserting characters that the PDF isn't likely to have
-				# a glyph for.
-				if current_font and current_font.BaseFont:
-					fontcache.setdefault(current_font.BaseFont, set()).update(token.value)
-			return token
-
-		# Iterate through the tokens in the page's content streams.
-		for token in tokenize_streams(content.stream for content in contents):
-			# Replace any string token with our own class that hold a mutable
-			# value, which is how we'll rewrite content.
+# The content stream operators that build_page_text_layer acts on.
+TEXT_LAYER_OPERATORS = frozenset(("Tj", "'", '"', "TJ", "Tf"))
+
+def build_page_text_layer(page, text_tokens, fontcache, options):
+	# Tokenize a page's content streams and append the text tokens shown by
+	# text-showing operators to text_tokens. Returns a list of all of the
+	# page's tokens, which is used to write the content stream back out.
+
+	from pdfrw import PdfObject, PdfString, PdfArray
+	from pdfrw.uncompress import uncompress as uncompress_streams
+	from pdfrw.objects.pdfname import BasePdfName
+
+	def process_text(token):
+		if token.value == "": return
+		text_tokens.append(token)
+
+	token_list = []
+	if page.Contents is None:
+		return token_list
+
+	prev_token = None
+	prev_prev_token = None
+	current_font = None
+	page_fonts = None
+
+	# The page may have one content stream or an array of content streams.
+	# If an array, they are treated as if they are concatenated into a single
+	# stream (per the spec).
+	if isinstance(page.Contents, PdfArray):
+		contents = list(page.Contents)
+	else:
+		contents = [page.Contents]
+
+	# If a compression Filter is applied, attempt to un-apply it. If an unrecognized
+	# filter is present, an error is raised. uncompress_streams expects an array of
+	# streams.
+	uncompress_streams(contents)
+
+	def make_mutable_string_token(token):
+		if isinstance(token, PdfString):
+			token = TextToken(token, current_font, fontcache, options)
+
+			# Remember all unicode characters seen in this font so we can
+			# avoid inserting characters that the PDF isn't likely to have
+			# a glyph for.
+			if current_font and current_font.BaseFont:
+				fontcache.setdefault(current_font.BaseFont, set()).update(token.value)
+		return token
+
+	# Iterate through the tokens in the page's content streams.
+	for token in tokenize_streams(content.stream for content in contents):
+		# Replace any string token with our own class that hold a mutable
+		# value, which is how we'll rewrite content.
+		if isinstance(token, PdfString):
 			token = make_mutable_string_token(token)
 
-			# Append the token into a new list that holds all tokens.
-			token_list.append(token)
-
-			# If the token is an operator and we're not inside an array...
-			if isinstance(token, PdfObject):
-				# And it's one that we recognize, process it.
-				if token in ("Tj", "'", '"') and isinstance(prev_token, TextToken):
-					# Simple text operators.
-					process_text(prev_token)
-				elif token == "TJ" and isinstance(prev_token, PdfArray):
-					# The text array operator.
-					for i in range(len(prev_token)):
-						# (item may not be a string! only the strings are text.)
-						prev_token[i] = make_mutable_string_token(prev_token[i])
-						if isinstance(prev_token[i], TextToken):
-							process_text(prev_token[i])
-
-				elif token == "Tf" and isinstance(prev_prev_token, BasePdfName):
-					# Update the current font.
-					# prev_prev_token holds the font 'name'. The name must be looked up
-					# in the content stream's resource dictionary, which is page.Resources,
-					# plus any resource dictionaries above it in the document hierarchy.
-					current_font = None
+		# Append the token into a new list that holds all tokens.
+		token_list.append(token)
+
+		# If the token is an operator and we're not inside an array, and it's
+		# one that we recognize (most tokens aren't, so check with a single
+		# set lookup first), process it.
+		if isinstance(token, PdfObject) and token in TEXT_LAYER_OPERATORS:
+			if token in ("Tj", "'", '"') and isinstance(prev_token, TextToken):
+				# Simple text operators.
+				process_text(prev_token)
+			elif token == "TJ" and isinstance(prev_token, PdfArray):
+				# The text array operator.
+				for i in range(len(prev_token)):
+					# (item may not be a string! only the strings are text.)
+					prev_token[i] = make_mutable_string_token(prev_token[i])
+					if isinstance(prev_token[i], TextToken):
+						process_text(prev_token[i])
+
+			elif token == "Tf" and isinstance(prev_prev_token, BasePdfName):
+				# Update the current font.
+				# prev_prev_token holds the font 'name'. The name must be looked up
+				# in the content stream's resource dictionary, which is page.Resources,
+				# plus any resource dictionaries above it in the document hierarchy.
+				if page_fonts is None:
+					# On the first Tf, collect the fonts available to the page
+					# so that each Tf is a single lookup.
+					page_fonts = { }
 					resources = page.Resources
-					while resources and not current_font:
-						current_font = resources.Font[prev_prev_token]
+					while resources:
+						for name, font in (resources.Font or { }).items():
+							if not page_fonts.get(name):
+								page_fonts[name] = font
 						resources = resources.Parent
-
-			# Remember the previously seen token in case the next operator is a text-showing
-			# operator -- in which case this was the operand. Remember the token before that
-			# because it may be a font name for the Tf operator.
-			prev_prev_token = prev_token
-			prev_token = token
-
-	return (text_tokens, page_tokens)
+				current_font = page_fonts.get(prev_prev_token)
+
+				# Load the font's CMap once now rather than for each string
+				# shown in the font.
+				if current_font and current_font.ToUnicode:
+					load_cmap(current_font, fontcache, options.cmap_cache)
+
+		# Remember the previously seen token in case the next operator is a text-showing
+		# operator -- in which case this was the operand. Remember the token before that
+		# because it may be a font name for the Tf operator.
+		prev_prev_token = prev_token
+		prev_token = token
+
+	return token_list
+
+
+class TextToken(object):
+	# A string operand of a text-showing operator, holding its decoded text in
+	# a mutable value. There is one per string in the content streams, so use
+	# __slots__ to keep them small.
+	__slots__ = ('value', 'font', 'fontcache', 'options', 'original_string',
+		'original_value', 'encoded', 'encoded_value')
+	def __init__(self, string, font, fontcache, options):
+		self.font = font
+		self.fontcache = fontcache
+		self.options = options
+		self.original_string = string # the pdfrw.PdfString from the content stream
+		self.original_value = toUnicode(string.to_bytes(), font, fontcache)
+		self.value = self.original_value
+		self.encoded = None # cached serialization of a changed value...
+		self.encoded_value = None # ...and the value it was made from
+	def __str__(self):
+		# __str__ is used for serialization
+		if self.value == self.original_value:
+			# If unchanged, return the string exactly as it appeared in the
+			# content stream, without decoding/encoding.
+			return self.original_string
+		if self.encoded is None or self.encoded_value != self.value:
+			# If the value changed, encode it from Unicode according to the encoding
+			# of the font that is active at the location of this token.
+			self.encoded = PdfString.from_bytes(fromUnicode(self.value, self.font, self.fontcache, self.options))
+			self.encoded_value = self.value
+		return self.encoded
+	def __repr__(self):
+		# __repr__ is used for debugging
+		return "Token<%s>" % repr(self.value)
 
 
 def chunk_pairs(s):
-	while len(s) >= 2:
-		yield (s.pop(0), s.pop(0))
+	# Iterate over consecutive pairs of items in s. Any leftover item is dropped.
+	it = iter(s)
+	return zip(it, it)
 
 
 def chunk_triples(s):
-	while len(s) >= 3:
-		yield (s.pop(0), s.pop(0), s.pop(0))
+	# Iterate over consecutive triples of items in s. Any leftover items are dropped.
+	it = iter(s)
+	return zip(it, it, it)
 
 
 class CMap(object):
 	def __init__(self, cmap):
 		self.bytes_to_unicode = { }
 		self.unicode_to_bytes = { }
+		self.int_to_unicode = { } # same as bytes_to_unicode but keyed by the integer code
 		self.defns = { }
 		self.usecmap = None
+		self.code_widths = set() # byte lengths of the character codes
+		self.decode_cache = { }
 
 		# Decompress the CMap stream & check that it's not compressed in a way
 		# we can't understand.
@@ -498,6 +578,7 @@ class CMap(object):
 
 		# This is based on https://github.com/euske/pdfminer/blob/master/pdfminer/cmapdb.py.
 		from pdfrw import PdfString, PdfArray
+		from functools import reduce
 		in_cmap = False
 		operand_stack = []
 		codespacerange = []
@@ -506,11 +587,12 @@ class CMap(object):
 			# decode hex encoding
 			code = code.to_bytes()
 			if sys.version_info < (3,):
-				code = (ord(c) for c in code)
-			from functools import reduce
-			return reduce(lambda x0, x : x0*256 + x, (b for b in code))
+				return reduce(lambda x0, x : x0*256 + x, (ord(c) for c in code))
+			return int.from_bytes(code, "big")
 
 		def add_mapping(code, char, offset=0):
+			int_code = code
+
 			# Is this a mapping for a one-byte or two-byte character code?
 			width = len(codespacerange[0].to_bytes())
 			assert len(codespacerange[1].to_bytes()) == width
@@ -527,6 +609,7 @@ class CMap(object):
 					code = bytes([code//256, code & 255])
 			else:
 				raise ValueError("Invalid code space range %s?" % repr(codespacerange))
+			self.code_widths.add(width)
 
 			# Some range operands take an array.
 			if isinstance(char, PdfArray):
@@ -536,12 +619,15 @@ class CMap(object):
 			# two-byte Unicode code points.
 			if isinstance(char, PdfString):
 				char = char.to_bytes()
-				if sys.version_info < (3,): char = (ord(c) for c in char)
-
-				c = ""
-				for xh, xl in chunk_pairs(list(char)):
-					c += (chr if sys.version_info >= (3,) else unichr)(xh*256 + xl)
-				char = c
+				if sys.version_info < (3,):
+					# There's no surrogatepass error handler, so take each
+					# two-byte code unit as is.
+					char = u"".join(unichr(ord(xh)*256 + ord(xl)) for xh, xl in chunk_pairs(char))
+				else:
+					# Surrogate pairs become a single character. A lone surrogate
+					# is kept as its code point so that it still maps back to
+					# its own character code.
+					char = char[:len(char) & ~1].decode("utf-16-be", "surrogatepass")
 
 				if offset > 0:
 					char = char[0:-1] + (chr if sys.version_info >= (3,) else unichr)(ord(char[-1]) + offset)
@@ -549,6 +635,7 @@ class CMap(object):
 				assert offset == 0
 
 			self.bytes_to_unicode[code] = char
+			self.int_to_unicode[int_code] = char
 			self.unicode_to_bytes[char] = code
 
 		for token in tokenize_streams([cmap.stream]):
@@ -573,7 +660,8 @@ class CMap(object):
 			elif token == "begincodespacerange":
 				operand_stack[:] = []
 			elif token == "endcodespacerange":
-				codespacerange = [operand_stack.pop(0), operand_stack.pop(0)]
+				codespacerange = operand_stack[0:2]
+				del operand_stack[0:2]
 
 			elif token in ("begincidrange", "beginbfrange"):
 				operand_stack[:] = []
@@ -602,11 +690,60 @@ class CMap(object):
 			else:
 				operand_stack.append(token)
 
+		if self.code_widths == set([1]):
+			# For one-byte codes, make a table for str.translate that maps each
+			# byte value (after decoding the string as Latin-1) to its
+			# Unicode string, or "?" if it has no mapping.
+			self.one_byte_table = dict((code, self.int_to_unicode.get(code, u"?"))
+				for code in range(256))
+
 	def dump(self):
 		for code, char in self.bytes_to_unicode.items():
 			print(repr(code), char)
 
 	def decode(self, string):
+		# The same strings tend to be shown over and over (common words,
+		# single spaces, etc.), so remember recent results, up to a limit.
+		ret = self.decode_cache.get(string)
+		if ret is None:
+			if len(self.decode_cache) >= 4096:
+				self.decode_cache.clear()
+			ret = self.decode_uncached(string)
+			self.decode_cache[string] = ret
+		return ret
+
+	def decode_uncached(self, string):
+		if self.code_widths == set([1]):
+			# All character codes are one byte, so the whole string can be
+			# mapped in one call.
+			return string.decode("Latin-1").translate(self.one_byte_table)
+
+		if self.code_widths == set([2]):
+			# All character codes are two bytes, so don't bother looking
+			# for one-byte entries. Look them up by their integer values,
+			# which avoids slicing out a new bytes object for each character.
+			# (Iterating a bytearray gives ints on Python 2 and 3.)
+			table = self.int_to_unicode
+			if len(string) % 2 == 0:
+				# Unpack all of the big-endian codes in one call. This is
+				# right unless a code has no mapping, in which case we have
+				# to fall back to resynchronizing byte by byte below.
+				chars = [table.get(code) for code in struct.unpack(">%dH" % (len(string) // 2), string)]
+				if None not in chars:
+					return "".join(chars)
+			string = bytearray(string)
+			ret = []
+			i = 0
+			while i < len(string):
+				char = table.get((string[i] << 8) | string[i+1]) if i+1 < len(string) else None
+				if char is not None:
+					ret.append(char)
+					i += 2
+				else:
+					ret.append("?")
+					i += 1
+			return "".join(ret)
+
 		ret = []
 		i = 0;
 		while i < len(string):
@@ -624,11 +761,38 @@ class CMap(object):
 		return "".join(ret)
 
 	def encode(self, string):
-		ret = []
-		for c in string:
-			ret.append(self.unicode_to_bytes.get(c, b""))
-		return b"".join(ret)
+		# Characters with no code are dropped.
+		table = self.unicode_to_bytes
+		return b"".join([table.get(c, b"") for c in string])
+
 
+# Parsed CMaps shared across documents, keyed by their decompressed streams.
+def load_cmap(font, fontcache, shared_cache=None):
+	# Decompress the CMap stream & check that it's not compressed in a way
+	# we can't understand.
+	from pdfrw.uncompress import uncompress as uncompress_streams
+	uncompress_streams([font.ToUnicode])
+
+	# Parse the CMap once per document, keyed by its decompressed stream.
+	stream = font.ToUnicode.stream
+	if stream not in fontcache:
+		if shared_cache is None:
+			cmap = CMap(font.ToUnicode)
+		else:
+			# Also look in the caller's cache of CMaps parsed from other
+			# documents (see RedactorOptions.cmap_cache), keyed by a digest
+			# of the stream so that the stream text itself isn't kept.
+			import copy, hashlib
+			key = hashlib.sha1(stream if isinstance(stream, bytes) else stream.encode("Latin-1")).digest()
+			cmap = shared_cache.get(key)
+			if cmap is None:
+				cmap = CMap(font.ToUnicode)
+				shared_cache[key] = cmap
+			# Give this document its own memo of decoded strings.
+			cmap = copy.copy(cmap)
+			cmap.decode_cache = { }
+		fontcache[stream] = cmap
+	return fontcache[stream]
 
 def toUnicode(string, font, fontcache):
 	# This is hard!
@@ -637,15 +801,11 @@ def toUnicode(string, font, fontcache):
 		# There is no font for this text. Assume Latin-1.
 		return string.decode("Latin-1")
 	elif font.ToUnicode:
-		# Decompress the CMap stream & check that it's not compressed in a way
-		# we can't understand.
-		from pdfrw.uncompress import uncompress as uncompress_streams
-		uncompress_streams([font.ToUnicode])
-
 		# Use the CMap, which maps character codes to Unicode code points.
-		if font.ToUnicode.stream not in fontcache:
-			fontcache[font.ToUnicode.stream] = CMap(font.ToUnicode)
-		cmap = fontcache[font.ToUnicode.stream]
+		# It is normally already loaded when the font was selected.
+		cmap = fontcache.get(font.ToUnicode.stream)
+		if cmap is None:
+			cmap = load_cmap(font, fontcache)
 
 		string = cmap.decode(string)
 		#print(string, end='', file=sys.stderr)
@@ -659,6 +819,29 @@ def toUnicode(string, font, fontcache):
 		return "?"
 		#raise ValueError("Don't know how to decode data from font %s." % font)
 
+class GlyphTable(dict):
+	# A translation table for str.translate that maps each character to
+	# itself if it occurs in a font, else to the first replacement glyph that
+	# occurs in the font, else to None to delete it. Entries are filled in
+	# as characters are looked up.
+	def __init__(self, char_occurs, replacement_glyphs):
+		self.char_occurs = char_occurs
+		self.replacement_glyphs = replacement_glyphs
+
+	def __missing__(self, codepoint):
+		c = (chr if sys.version_info >= (3,) else unichr)(codepoint)
+		for cc in [c] + self.replacement_glyphs:
+			if cc in self.char_occurs:
+				break
+		else:
+			cc = None # no replacement glyph => omit character
+		if sys.version_info < (3,) and isinstance(cc, str):
+			# unicode.translate only accepts unicode mapping values, but the
+			# replacement glyphs may be byte strings on Python 2.
+			cc = cc.decode("utf8")
+		self[codepoint] = cc
+		return cc
+
 def fromUnicode(string, font, fontcache, options):
 	# Filter out characters that are not likely to have renderable glyphs
 	# because the character didn't occur in the original PDF in its font.
@@ -666,13 +849,11 @@ def fromUnicode(string, font, fontcache, options):
 	# with the first character in options.content_replacement_glyphs that
 	# did occur in the original PDF. If none ocurred, delete the character.
 	if font and font.BaseFont in fontcache:
-		char_occurs = fontcache[font.BaseFont]
-		def map_char(c):
-			for cc in [c] + options.content_replacement_glyphs:
-				if cc in char_occurs:
-					return cc
-			return "" # no replacement glyph => omit character
-		string = "".join(map_char(c) for c in string)
+		# Build a str.translate table for the font once and re-use it.
+		table_key = ("glyphs", font.BaseFont)
+		if table_key not in fontcache:
+			fontcache[table_key] = GlyphTable(fontcache[font.BaseFont], options.content_replacement_glyphs)
+		string = string.translate(fontcache[table_key])
 
 	# Encode the Unicode string in the same encoding that it was originally
 	# stored in --- based on the font that was active when the token was
@@ -697,50 +878,90 @@ def fromUnicode(string, font, fontcache, options):
 		raise ValueError("Don't know how to encode data to font %s." % font)
 
 def update_text_layer(options, text_tokens, page_tokens):
+	# Returns whether any text was replaced.
+
 	if len(text_tokens) == 0:
 		# No text content.
-		return
+		return False
+
+	from bisect import bisect_right
 
 	# Apply each regular expression to the text content...
+	text_content_stale = True
+	text_changed = False
 	for pattern, function in options.content_filters:
-		# Finding all matches...
-		text_tokens_index = 0
-		text_tokens_charpos = 0
-		text_tokens_token_xdiff = 0
-		text_content = "".join(t.value for t in text_tokens)
+		# The filters are chained: each one sees the text as rewritten by the
+		# filters before it, so they can't be merged into a single scan. But
+		# we only need to rebuild the text content if the previous filter
+		# matched anything.
+		if text_content_stale:
+			values = [t.value for t in text_tokens]
+			text_content = "".join(values)
+			text_content_stale = False
+
+			# Record where each token's text ends in the text content so that
+			# we can binary search for the token that produced a match.
+			text_tokens_ends = []
+			text_tokens_charpos = 0
+			for value in values:
+				text_tokens_charpos += len(value)
+				text_tokens_ends.append(text_tokens_charpos)
+
+		# Finding all matches... The replacements are collected for each token
+		# and made after the last match, so that a token's text is rebuilt
+		# only once no matter how many matches fall within it.
+		token_edits = { }
+
+		# A replacement string without backslashes is used as is for every
+		# match, rather than being expanded as a template each time.
+		literal_replacement = None
+		if not callable(function) and "\\" not in function:
+			literal_replacement = function
+
 		for m in pattern.finditer(text_content):
 			# We got a match at text_content[i1:i2].
 			i1 = m.start()
 			i2 = m.end()
 
-			# Pass the matched text to the replacement function to get replaced text.
-			replacement = function(m)
+			# Pass the matched text to the replacement function to get replaced text,
+			# or expand the replacement template (like re.sub does) if a string was
+			# given instead of a function.
+			if literal_replacement is not None:
+				replacement = literal_replacement
+			elif callable(function):
+				replacement = function(m)
+			else:
+				replacement = m.expand(function)
+
+			# If the text isn't actually changing, there's nothing to do.
+			if replacement == m.group(0):
+				continue
+
+			# The tokens are about to change.
+			text_content_stale = True
+			text_changed = True
 
 			# Do a text replacement in the tokens that produced this text content.
 			# It may have been produced by multiple tokens, so loop until we find them all.
 			while i1 < i2:
 				# Find the original tokens in the content stream that
-				# produced the matched text. Start by advancing over any
-				# tokens that are entirely before this span of text.
-				while text_tokens_index < len(text_tokens) and \
-				      text_tokens_charpos + len(text_tokens[text_tokens_index].value)-text_tokens_token_xdiff <= i1:
-					text_tokens_charpos += len(text_tokens[text_tokens_index].value)-text_tokens_token_xdiff
-					text_tokens_index += 1
-					text_tokens_token_xdiff = 0
-				if text_tokens_index == len(text_tokens): break
+				# produced the matched text. Skip over any tokens that
+				# are entirely before this span of text.
+				index = bisect_right(text_tokens_ends, i1)
+				if index == len(text_tokens): break
+				text_tokens_charpos = text_tokens_ends[index-1] if index > 0 else 0
 				assert(text_tokens_charpos <= i1)
 
-				# The token at text_tokens_index, and possibly subsequent ones,
-				# are responsible for this text. Replace the matched content
+				# The token at index, and possibly subsequent ones, are
+				# responsible for this text. Replace the matched content
 				# here with replacement content.
-				tok = text_tokens[text_tokens_index]
 
 				# Where does this match begin within the token's text content?
 				mpos = i1 - text_tokens_charpos
 				assert mpos >= 0
 
 				# How long is the match within this token?
-				mlen = min(i2-i1, len(tok.value)-text_tokens_token_xdiff-mpos)
+				mlen = min(i2-i1, text_tokens_ends[index]-i1)
 				assert mlen >= 0
 
 				# How much should we replace here?
@@ -755,34 +976,75 @@ def update_text_layer(options, text_tokens, page_tokens):
 					r = replacement
 					replacement = None # sanity
 
-				# Do the replacement.
-				tok.value = tok.value[:mpos+text_tokens_token_xdiff] + r + tok.value[mpos+mlen+text_tokens_token_xdiff:]
-				text_tokens_token_xdiff += len(r) - mlen
+				# Queue the replacement.
+				token_edits.setdefault(index, []).append((mpos, mpos+mlen, r))
 
 				# Advance for next iteration.
 				i1 += mlen
 
+		# Do the replacements, stitching each token's text back together from
+		# the unmatched parts and the replacement text.
+		for index, edits in token_edits.items():
+			tok = text_tokens[index]
+			pieces = []
+			pos = 0
+			for start, end, r in edits:
+				pieces.append(tok.value[pos:start])
+				pieces.append(r)
+				pos = end
+			pieces.append(tok.value[pos:])
+			tok.value = "".join(pieces)
+
+	return text_changed
+
 def apply_updated_text(document, text_tokens, page_tokens):
 	# Create a new content stream for each page by concatenating the
 	# tokens in the page_tokens lists.
 	from pdfrw import PdfArray
+
+	# Unfortunately the str on PdfArray and PdfDict doesn't work right, so
+	# serialize those ourselves. Rather than building up nested strings,
+	# append all of the pieces to one list that gets joined at the end.
+	def write_token(tok, out):
+		if isinstance(tok, PdfArray):
+			out.append("[ ")
+			for j, x in enumerate(tok):
+				if j > 0: out.append(" ")
+				write_token(x, out)
+			out.append("] ")
+		elif isinstance(tok, InlineImage):
+			out.append("BI ")
+			for j, (x, y) in enumerate(tok.items()):
+				if j > 0: out.append(" ")
+				write_token(x, out)
+				out.append(" ")
+				write_token(y, out)
+			out.append(" ID ")
+			out.append(tok.stream)
+			out.append(" EI ")
+		elif isinstance(tok, PdfDict):
+			out.append("<< ")
+			for j, (x, y) in enumerate(tok.items()):
+				if j > 0: out.append(" ")
+				write_token(x, out)
+				out.append(" ")
+				write_token(y, out)
+			out.append(">> ")
+		else:
+			out.append(str(tok))
+
 	for i, page in enumerate(document.pages):
 		if page.Contents is None: continue # nothing was here
 
 		# Replace the page's content stream with our updated tokens.
 		# The content stream may have been an array of streams before,
-		# so replace the whole thing with a single new stream. Unfortunately
-		# the str on PdfArray and PdfDict doesn't work right.
-		def tok_str(tok):
-			if isinstance(tok, PdfArray):
-				return "[ " + " ".join(tok_str(x) for x in tok) + "] "
-			if isinstance(tok, InlineImage):
-				return "BI " + " ".join(tok_str(x) + " " + tok_str(y) for x,y in tok.items()) + " ID " + tok.stream + " EI "
-			if isinstance(tok, PdfDict):
-				return "<< " + " ".join(tok_str(x) + " " + tok_str(y) for x,y in tok.items()) + ">> "
-			return str(tok)
+		# so replace the whole thing with a single new stream.
+		out = []
+		for j, tok in enumerate(page_tokens[i]):
+			if j > 0: out.append("\n")
+			write_token(tok, out)
 		page.Contents = PdfDict()
-		page.Contents.stream = "\n".join(tok_str(tok) for tok in page_tokens[i])
+		page.Contents.stream = "".join(out)
 		page.Contents.Length = len(page.Contents.stream) # reset
 
 
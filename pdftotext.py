@@ -6,6 +6,8 @@ import pdf_redactor
 
 ## Set options.
 
+ALL_TEXT = re.compile(r"[\w\W]+")
+
 def printer(m):
 	s = m.group(0)
 	if sys.version_info < (3,):
@@ -15,5 +17,5 @@ def printer(m):
 
 options = pdf_redactor.RedactorOptions()
 options.output_stream = io.BytesIO() # null
-options.content_filters = [(re.compile("[\w\W]+"), printer)]
+options.content_filters = [(ALL_TEXT, printer)]
 pdf_redactor.redactor(options)
@@ -46,7 +46,6 @@ setup(
 	],
 	tests_require=[
 		'nose',
-		'textract',
 	],
 	test_suite='tests.run_tests.main',
 )
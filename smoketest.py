@@ -21,7 +21,11 @@ except ImportError:
 	try:
 		from tqdm import tqdm
 	except ImportError:
-		tqdm = lambda it: it
+		tqdm = lambda it, **kwargs: it
+
+
+# Compiled once per process rather than once per file.
+WORD_PATTERN = re.compile(r"\w+")
 
 
 def metadata_filter(value):
@@ -34,7 +38,10 @@ def smoke_test_file(path):
 	options = pdf_redactor.RedactorOptions()
 	options.input_stream = open(path, "rb")
 	options.output_stream = io.BytesIO()
-	options.content_filters = [(re.compile("\w+"), lambda match: match.group(0))]
+	# Reverse each word so that the text actually changes (identity replacements
+	# are skipped) and the content streams are rewritten, using only characters
+	# that are already in the PDF.
+	options.content_filters = [(WORD_PATTERN, lambda match: match.group(0)[::-1])]
 	options.metadata_filters = {"ALL": [metadata_filter]}
 	try:
 		pdf_redactor.redactor(options)
@@ -64,14 +71,14 @@ def gen_filenames(paths):
 
 
 def main(paths):
+	filenames = list(gen_filenames(paths))
 	with multiprocessing.Pool() as pool:
-		open_tasks = []
-		for fn in tqdm(list(gen_filenames(paths))):
-			open_tasks.append(pool.apply_async(smoke_test_file, [fn]))
-			if len(open_tasks) > 20:
-				open_tasks.pop(0).wait()
-		pool.close()
-		pool.join()
+		# Hand out files in small batches to cut down on IPC, and take results
+		# in whatever order they finish so one slow file doesn't hold up the
+		# others.
+		results = pool.imap_unordered(smoke_test_file, filenames, chunksize=8)
+		for _ in tqdm(results, total=len(filenames)):
+			pass
 
 if __name__ == "__main__":
 	main(sys.argv[1:])